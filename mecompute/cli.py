@@ -5,10 +5,14 @@ Command line interface (cli) of the program, type `me-compute --help` on the ter
 import os
 import sys
 import csv
+import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 from http.client import HTTPException
+from io import BytesIO
 from os.path import join, dirname, isdir, basename, splitext, isfile, abspath, isabs
 from urllib.error import URLError, HTTPError
+from urllib.request import urlopen
 
 import click
 import pandas as pd
@@ -29,6 +33,8 @@ SEGMENTS_SELECTION_PATH = join(_CONFIG_DIR, 'segments_selection.yaml')
 assert isfile(STATION_ME_CONFIG_PATH)
 assert isfile(HTML_REPORT_TEMPLATE_PATH)
 assert isfile(SEGMENTS_SELECTION_PATH)
+# max number of QuakeMLs downloaded concurrently from the event web service:
+_QUAKEML_MAX_WORKERS = 4
 
 
 #########################
@@ -141,6 +147,7 @@ def cli(d_config, start, end, time_window, force_overwrite, p_config, h_template
         sys.exit(1)
 
     start, end = _get_timebounds(start, end, time_window)
+    start, end = _isoformat(start), _isoformat(end)
     print(f'Computing Me for events within: [{start}, {end}]', file=sys.stderr)
     dest_dir = output_dir.replace("%S%", start).replace("%E%", end)
     ret = compute_me(d_config, start, end, dest_dir, seg_sel=segments_selection,
@@ -224,9 +231,13 @@ def compute_me(dconfig, start, end, dest_dir, seg_sel,
         logger.info(f'Fetching station energy magnitudes from {station_me_file}')
 
     try:
+        # read only the needed columns (the file is written in 'table' format):
         station_me_df: pd.DataFrame = pd.read_hdf(station_me_file,
-                                                  usecols=_REQUIRED_STATIONS_COLUMNS)
+                                                  columns=_REQUIRED_STATIONS_COLUMNS)
         assert 'event_db_id' in station_me_df.columns
+        # few distinct values repeated many times, use categories (faster groupby):
+        station_me_df = station_me_df.astype({'network': 'category',
+                                              'station': 'category'})
     except ValueError:
         logger.warning('Unable to read station energy magnitudes file. '
                        'This might be due to no Me computed (e.g., no segment, '
@@ -293,18 +304,30 @@ def write_events_me_csv(station_me_df: pd.DataFrame, dburl, csv_path):
 
 def write_quakemls(events: dict, dest_dir):
     author_uri = "https://github.com/rizac/me-compute"
-    for evt_id, evt in events.items():
-        # write QuakeML:
-        try:
+    # download the QuakeMLs concurrently (I/O bound), but parse, edit and write
+    # them serially here (ObsPy event objects are not documented as thread-safe):
+    with ThreadPoolExecutor(max_workers=_QUAKEML_MAX_WORKERS) as executor:
+        downloads = [(evt, executor.submit(_download_quakeml, evt))
+                     for evt in events.values()]
+        for evt, download in downloads:
             ev_catalog_id = evt['id']
-            ev_catalog_url = evt['url']
-            e_mag, e_mag_u = evt['Me'], evt['Me_stddev']
-            quakeml_file = join(dest_dir, ev_catalog_id + '.xml')
-            _write_quekeml(quakeml_file, ev_catalog_url,
-                           e_mag, e_mag_u, evt['Me_waveforms_used'],
-                           author_uri, force_overwrite=True)
-        except (OSError, HTTPError, HTTPException, URLError) as exc:
-            logger.warning(f'Unable to create QuakeML for {ev_catalog_id}: {exc}')
+            try:
+                quakeml = download.result()
+                e_mag, e_mag_u = evt['Me'], evt['Me_stddev']
+                quakeml_file = join(dest_dir, ev_catalog_id + '.xml')
+                _write_quekeml(quakeml_file, BytesIO(quakeml),
+                               e_mag, e_mag_u, evt['Me_waveforms_used'],
+                               author_uri, force_overwrite=True)
+            except (OSError, HTTPError, HTTPException, URLError) as exc:
+                logger.warning(f'Unable to create QuakeML for {ev_catalog_id}: {exc}')
+
+
+def _download_quakeml(evt: dict):
+    """Return the QuakeML of the given event (dict) as bytes, downloaded from the
+    event URL. Raise URLError if the event Me is not finite (nothing to write)"""
+    _check_me(evt['Me'])
+    with urlopen(evt['url']) as response:
+        return response.read()
 
 
 def write_html_report(station_me_df: pd.DataFrame, events: dict,
@@ -324,15 +347,16 @@ def write_html_report(station_me_df: pd.DataFrame, events: dict,
         html_evts[evt_db_id] = [[evt[h] for h in ev_headers], stations]
 
     with open(html_fpath, 'w') as _:
-        _.write(template.render(title=title,
-                                selected_event_id=int(selected_event_id),
-                                event_data=html_evts, event_headers=ev_headers))
+        # stream to file, without building the whole HTML string in memory:
+        template.stream(title=title,
+                        selected_event_id=int(selected_event_id),
+                        event_data=html_evts, event_headers=ev_headers).dump(_)
     return True
 
 
 def _get_timebounds(start=None, end=None, duration=1):
     """
-    return the tuple start:str, end:str from the arguments. If start and
+    return the tuple start:datetime, end:datetime from the arguments. If start and
     end are None, then they will default to yesterday
 
     :param start: datetime or None, the start time
@@ -346,10 +370,12 @@ def _get_timebounds(start=None, end=None, duration=1):
         end = start + timedelta(days=duration)
     elif start is None:
         start = end - timedelta(days=duration)
-    return _isoformat(start), _isoformat(end)
+    return start, end
 
 
 def _isoformat(time):
+    """return the ISO-formatted string of the given datetime, with no time part
+    if the latter is midnight"""
     if time.hour == time.minute == time.second == time.microsecond == 0:
         return date(year=time.year, month=time.month, day=time.day).isoformat()
     return time.isoformat(sep='T')
@@ -370,7 +396,11 @@ def compute_stations_me(outfile, dburl, segments_selection, p_config):
             'location': 2,
             'channel': 3,
             # 'ev_mty': 2,
-        }
+        },
+        # compress the HDF (mostly repeated strings and floats). blosc:lz4 is fast
+        # enough to keep the write overhead marginal:
+        'complib': 'blosc:lz4',
+        'complevel': 5
     }
 
     s2s_process(compute_station_me, outfile=outfile,
@@ -381,17 +411,22 @@ def compute_stations_me(outfile, dburl, segments_selection, p_config):
                 multi_process=True, chunksize=None)
 
 
-def _write_quekeml(dest_file, event_url, me, me_u=None, me_stations=None,
+def _check_me(me):
+    if me is None or not math.isfinite(me):
+        raise URLError('Me is N/A (nan, +-inf, None)')
+
+
+def _write_quekeml(dest_file, event_quakeml, me, me_u=None, me_stations=None,
                    author="", force_overwrite=False):
-    with pd.option_context('mode.use_inf_as_na', True):
-        if pd.isna(me):
-            raise URLError('Me is N/A (nan, +-inf, None)')
+    """Write the given event QuakeML (URL, path or file-like object, as accepted by
+    `obspy.read_events`) with the given Me added, to `dest_file`"""
+    _check_me(me)
 
     if isfile(dest_file) and not force_overwrite:
         return dest_file
 
     from obspy.core.event import read_events, Magnitude, CreationInfo, QuantityError
-    evt = read_events(event_url)
+    evt = read_events(event_quakeml)
     if len(evt) == 1:
         mag = Magnitude()
         mag.mag = me
@@ -3,6 +3,7 @@ import numpy as np
 import math
 import logging
 
+from abc import ABC, abstractmethod
 from enum import Enum
 from sqlalchemy.orm import load_only
 
@@ -10,6 +11,9 @@ from stream2segment.process import Event, get_session
 
 logger = logging.getLogger('me-compute.event_me')
 
+# max number of events fetched from the database with a single query:
+_EVENTS_QUERY_CHUNKSIZE = 500
+
 
 def compute_events_me(station_me: pd.DataFrame, dburl):
     """Yield Events in form of dicts from the given station_me and dburl"""
@@ -24,74 +28,179 @@ def _compute_events_me(station_me: pd.DataFrame, db_session):
     """Yield Events in form of dicts from the given station_me and db session"""
     # see process.py:main for a list of columns:
     dfr = station_me
-    for ev_db_id, evt_df in dfr.groupby('event_db_id'):
+    evts_stats = []
+    for ev_db_id, waveforms_count, me, me_std, num_waveforms, stations_count in \
+            events_me_stats(dfr).itertuples(name=None):
 
-        me_values = np.asarray(evt_df['station_energy_magnitude'].values)
-        waveforms_count = np.sum(np.isfinite(me_values))
         if not waveforms_count:
             logger.warning(f'Event {ev_db_id} skipped: no finite Me value found')
             continue
-        me, me_std, num_waveforms = avg_std_count_within_percentiles(me_values)
-        with pd.option_context('mode.use_inf_as_na', True):
-            if pd.isna(me):
-                logger.warning(f'Event {ev_db_id} skipped: Me is NaN '
-                               f'(e.g. not enough station Me available)')
-                continue
-
-        event = db_session.query(Event).\
+        if not np.isfinite(me):
+            logger.warning(f'Event {ev_db_id} skipped: Me is NaN '
+                           f'(e.g. not enough station Me available)')
+            continue
+        evts_stats.append((int(ev_db_id), waveforms_count, me, me_std, num_waveforms,
+                           stations_count))
+
+    # query the db events in chunks, instead of one query per event:
+    for i in range(0, len(evts_stats), _EVENTS_QUERY_CHUNKSIZE):
+        chunk = evts_stats[i: i + _EVENTS_QUERY_CHUNKSIZE]
+        db_events = {
+            event.id: event for event in db_session.query(Event).
             options(load_only(Event.magnitude, Event.mag_type, Event.webservice_id,
                               Event.latitude, Event.longitude, Event.depth_km,
-                              Event.time, Event.event_id)).\
-            filter(Event.id == ev_db_id).one()
-
-        group_sta = evt_df.groupby(['network', 'station'])
-        yield {  # we are working in python 3.6.9+, order is preserved
-            'url': event.url,
-            'magnitude': event.magnitude,
-            'magnitude_type': event.mag_type,
-            'Me': float(np.round(me, 2)),
-            'Me_stddev': float(np.round(me_std, 3)),
-            'Me_waveforms_used': int(num_waveforms),
-            'latitude': float(np.round(event.latitude, 5)),
-            'longitude': float(np.round(event.longitude, 5)),
-            'depth_km': float(np.round(event.depth_km, 3)),
-            'time': event.time.isoformat('T'),
-            'stations': int(group_sta.ngroups),
-            'waveforms': int(waveforms_count),
-            'id': str(event.event_id),
-            'db_id': int(ev_db_id),  # noqa
+                              Event.time, Event.event_id)).
+            filter(Event.id.in_([_[0] for _ in chunk]))
         }
+        for ev_db_id, waveforms_count, me, me_std, num_waveforms, stations_count in \
+                chunk:
+            event = db_events[ev_db_id]
+            yield {  # we are working in python 3.6.9+, order is preserved
+                'url': event.url,
+                'magnitude': event.magnitude,
+                'magnitude_type': event.mag_type,
+                'Me': float(np.round(me, 2)),
+                'Me_stddev': float(np.round(me_std, 3)),
+                'Me_waveforms_used': int(num_waveforms),
+                'latitude': float(np.round(event.latitude, 5)),
+                'longitude': float(np.round(event.longitude, 5)),
+                'depth_km': float(np.round(event.depth_km, 3)),
+                'time': event.time.isoformat('T'),
+                'stations': int(stations_count),
+                'waveforms': int(waveforms_count),
+                'id': str(event.event_id),
+                'db_id': int(ev_db_id),  # noqa
+            }
+
+
+def events_me_stats(station_me: pd.DataFrame, plow=5, phigh=95, round=2):
+    """Return a DataFrame with the energy magnitude statistics of all events in
+    `station_me`, computed with vectorized group operations instead of a Python
+    loop over the events. The DataFrame is indexed by event database id (sorted
+    ascending) and has columns:
+    'waveforms' (number of finite station Me),
+    'Me', 'Me_stddev', 'Me_waveforms_used' (average, standard deviation and count
+    of the finite station Me within the given percentiles, as in
+    `avg_std_count_within_percentiles`. Average and stddev are NaN if no value
+    is found),
+    'stations' (number of distinct stations)
+    """
+    # map event ids to integer codes (0 to num events - 1), so that per-event sums
+    # and counts can be computed with `np.bincount`:
+    codes, ev_ids = pd.factorize(station_me['event_db_id'], sort=True)
+    num_events = len(ev_ids)
+    # distinct stations per event (the first row of each event station):
+    is_first = ~station_me.duplicated(['event_db_id', 'network', 'station']).to_numpy()
+    stations = np.bincount(codes[is_first], minlength=num_events)
+
+    me_values = station_me['station_energy_magnitude'].to_numpy(dtype=float)
+    finite = np.isfinite(me_values)
+    codes, me_values = codes[finite], me_values[finite]
+    waveforms = np.bincount(codes, minlength=num_events)
+
+    p_low, p_high = grouped_percentiles(me_values, codes, num_events, [plow, phigh])
+    in_range = (me_values >= p_low[codes]) & (me_values <= p_high[codes])
+    codes, me_values = codes[in_range], me_values[in_range]
+
+    count = np.bincount(codes, minlength=num_events)
+    with np.errstate(divide='ignore', invalid='ignore'):  # count might be 0 (=> NaN)
+        mean = np.bincount(codes, weights=me_values, minlength=num_events) / count
+        sq_dev = me_values - mean[codes]
+        np.square(sq_dev, out=sq_dev)
+        std = np.sqrt(np.bincount(codes, weights=sq_dev, minlength=num_events) / count)
+
+    return pd.DataFrame({
+        'waveforms': waveforms,
+        'Me': np.round(mean, round),
+        'Me_stddev': np.round(std, round),
+        'Me_waveforms_used': count,
+        'stations': stations
+    }, index=pd.Index(ev_ids, name='event_db_id'))
+
+
+def grouped_percentiles(values, codes, num_groups, percentiles):
+    """Return the percentiles of `values` grouped by `codes`, as numpy array of shape
+    `(len(percentiles), num_groups)`. Each percentile is computed as in
+    `np.percentile` (linear interpolation) for all groups at once, sorting `values`
+    only once. Empty groups have NaN percentiles
+
+    :param values: numpy array of finite values
+    :param codes: numpy array of non-negative integers < num_groups (same length as
+        `values`), denoting the group of each value
+    :param num_groups: the number of groups
+    :param percentiles: list of percentiles in [0, 100]
+    """
+    sorted_values = values[np.lexsort((values, codes))]
+    counts = np.bincount(codes, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    ret = np.full((len(percentiles), num_groups), np.nan)
+    non_empty = counts > 0
+    counts, starts = counts[non_empty], starts[non_empty]
+    for i, perc in enumerate(percentiles):
+        rank = (counts - 1) * (perc / 100.)
+        idx_low = np.floor(rank).astype(int)
+        idx_high = np.minimum(idx_low + 1, counts - 1)
+        val_low = sorted_values[starts + idx_low]
+        val_high = sorted_values[starts + idx_high]
+        # interpolate as numpy does (from the closest value, for numerical stability):
+        weight = rank - idx_low
+        diff = val_high - val_low
+        ret[i, non_empty] = np.where(weight >= 0.5,
+                                     val_high - diff * (1 - weight),
+                                     val_low + diff * weight)
+    return ret
 
 
 def get_html_report_rows(station_me: pd.DataFrame, events: dict):
-    # Stations residuals:
-    for ev_db_id, evt_df in station_me.groupby('event_db_id'):
-        group_sta = evt_df.groupby(['network', 'station'])
+    # Stations residuals. Take the first row of each event station (as station Me
+    # are computed per channel) once for all events, sorted by event and station:
+    sta_tbl = station_me.drop_duplicates(['event_db_id', 'network', 'station']).\
+        sort_values(['event_db_id', 'network', 'station'], kind='stable')
+    # build all station codes "net.sta" at once:
+    sta_tbl = sta_tbl.assign(netsta=sta_tbl['network'].astype(str) + '.' +
+                             sta_tbl['station'].astype(str))
+    # round all coordinates and distances at once:
+    sta_tbl = sta_tbl.round({'station_latitude': 3, 'station_longitude': 3,
+                             'station_event_distance_deg': 3})
+    if sta_tbl.empty:
+        return
+    # convert columns once for all events:
+    lats = _finite_or_none(sta_tbl['station_latitude'])
+    lons = _finite_or_none(sta_tbl['station_longitude'])
+    netstas = sta_tbl['netsta'].to_numpy()
+    station_mes = sta_tbl['station_energy_magnitude'].to_numpy(dtype=float)
+    dists = _finite_or_none(sta_tbl['station_event_distance_deg'])
+    # iterate over event slices (sta_tbl is sorted by event) without building
+    # a sub-DataFrame per event:
+    ev_db_ids = sta_tbl['event_db_id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, ev_db_ids[1:] != ev_db_ids[:-1]])
+    ends = np.r_[starts[1:], len(ev_db_ids)]
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        ev_db_id = ev_db_ids[start].item()
         stas = []
-        for (net, sta), sta_df in group_sta:
-            lat = np.round(sta_df['station_latitude'].iat[0], 3)
-            lon = np.round(sta_df['station_longitude'].iat[0], 3)
-            delta_me = None
-            me = events.get(ev_db_id, {}).get('Me', None)
-            if me is None:
-                continue
-            station_me = sta_df['station_energy_magnitude'].iat[0]
-            with pd.option_context('mode.use_inf_as_na', True):
-                if not pd.isna(station_me):
-                    delta_me = float(np.round(station_me - me, 2))
-
-            # res = np.nan if invalid_me else \
-            #     sta_df['station_energy_magnitude'].iat[0] - me_st_mean
-            dist_deg = np.round(sta_df['station_event_distance_deg'].iat[0], 3)
-            stas.append([lat if np.isfinite(lat) else None,
-                         lon if np.isfinite(lon) else None,
-                         net + '.' + sta,
-                         delta_me,
-                         dist_deg if np.isfinite(dist_deg) else None])
+        me = events.get(ev_db_id, {}).get('Me', None)
+        if me is not None:
+            delta_me = np.round(station_mes[start: end] - me, 2)
+            stas = list(map(list, zip(
+                lats[start: end],
+                lons[start: end],
+                netstas[start: end],
+                _finite_or_none(delta_me),
+                dists[start: end]
+            )))
 
         yield events[ev_db_id], stas
 
 
+def _finite_or_none(values):
+    """Return a numpy array of Python objects from the given numeric values, where
+    non-finite values (NaN, +-inf) are replaced by None"""
+    values = np.asarray(values, dtype=float)
+    ret = values.astype(object)
+    ret[~np.isfinite(values)] = None
+    return ret
+
+
 def avg_std_count(values, weights=None, na_repr=None, round=None):
     """Return the weighted average, standard deviation and count of finite values
     from the arguments
@@ -107,8 +216,10 @@ def avg_std_count(values, weights=None, na_repr=None, round=None):
     mean, std, count = na_repr, na_repr, len(values)
     if count > 0:
         average = np.average(values, weights=weights)
-        # stddev:
-        variance = np.average((values - average) ** 2, weights=weights)
+        # stddev (two-pass algorithm, squaring the deviations in-place):
+        sq_dev = values - average
+        np.square(sq_dev, out=sq_dev)
+        variance = np.average(sq_dev, weights=weights)
         mean, std = float(average), math.sqrt(variance)
         if round is not None:
             mean = np.round(mean, round)
@@ -141,46 +252,101 @@ def avg_std_count_anomalyscore_th(values, anomalyscores, score_th=.75, round=2):
 def avg_std_count_anomalyscore_weight(values, anomalyscores, round=2):
     """Return the average, stddev and count of the given values, with weights
     mapped linearly from the inverse of the given anomaly scores
-    See avg_std_count for details
+    See avg_std_count and LinearScore2Weight for details
     """
-    maxscore = 0.86059521298447561
-    minscore = 0.41729107098205132
-    weights = 1 - ((anomalyscores-minscore) / (maxscore-minscore))
-    #            |
-    #          1 +  ooo
-    #  weight    |       o
-    #          0 +          ooo
-    #            +----+-----+-----
-    #                .4    .8
-    #              anomalyscore
-    return avg_std_count(values, np.clip(weights, 0., 1.), None, round=round)
+    weights = LinearScore2Weight.convert(anomalyscores)
+    if weights is None:  # no finite weight (see avg_std_count)
+        return [None, None, 0]
+    return avg_std_count(values, weights, None, round=round)
 
 
 def avg_std_count_anomalyscore_weight2(values, anomalyscores, round=2):
     """Return the average, stddev and count of the given values, with weights
     mapped non-linearly from the inverse of the given anomaly scores
-    See avg_std_count for details
+    See avg_std_count and ParabolicScore2Weight for details
+    """
+    weights = ParabolicScore2Weight.convert(anomalyscores)
+    if weights is None:  # no finite weight (see avg_std_count)
+        return [None, None, 0]
+    return avg_std_count(values, weights, None, round=round)
+
+
+class Score2Weight(ABC):
+    """Abstract class converting amplitude anomaly scores into weights in [0, 1].
+    Subclasses must implement `_to_weights`
     """
+
     maxscore = 0.86059521298447561
     minscore = 0.41729107098205132
-    # use a parabola fitting with vertex in (0.5, 1): all scores
-    # <=0.5 are converted to weight 1, all scores >0.5 have weights
-    # decreasing parabolically:
-    #            |
-    #          1 +  ooo
-    #            |       o
-    #  weight    |        o
-    #          0 +         ooo0
-    #            +----+----+-----
-    #                .5   .8
-    #              anomalyscore
-    #
-    # The fitting parabola has vertex in (0.5, 1)
-    # and passes through (maxscore, 0)
-    # the coefficients (calculated manually) are:
-    b = 1. / (maxscore ** 2 - maxscore + 0.25)
-    a = -b
-    c = 1. - b / 4.0
-    weights = a * anomalyscores ** 2 + b * anomalyscores + c
-    weights[anomalyscores <= 0.5] = 1.
-    return avg_std_count(values, np.clip(weights, 0., 1.), None, round=round)
+
+    @classmethod
+    def convert(cls, scores):
+        """Return a new numpy array of weights in [0, 1] from the given anomaly
+        scores (NaN scores are converted to NaN), or None if no score is finite
+        """
+        scores = np.asarray(scores, dtype=float)
+        if not np.isfinite(scores).any():
+            return None
+        weights = cls._to_weights(scores)
+        return np.clip(weights, 0., 1., out=weights)
+
+    @classmethod
+    @abstractmethod
+    def _to_weights(cls, scores):
+        """Return a new numpy array of (non clipped) weights from the given scores"""
+
+
+class LinearScore2Weight(Score2Weight):
+    """Convert amplitude anomaly scores into weights mapped linearly from the
+    inverse of the scores:
+    ```
+               |
+             1 +  ooo
+     weight    |       o
+             0 +          ooo
+               +----+-----+-----
+                   .4    .8
+                 anomalyscore
+    ```
+    """
+
+    @classmethod
+    def _to_weights(cls, scores):
+        # weights = 1 - ((scores - minscore) / (maxscore - minscore)), in-place:
+        weights = scores - cls.minscore
+        weights /= cls.maxscore - cls.minscore
+        return np.subtract(1., weights, out=weights)
+
+
+class ParabolicScore2Weight(Score2Weight):
+    """Convert amplitude anomaly scores into weights mapped non-linearly from the
+    inverse of the scores. Use a parabola with vertex in (0.5, 1) passing through
+    (maxscore, 0): all scores <=0.5 are converted to weight 1, all scores > 0.5
+    have weights decreasing parabolically:
+    ```
+               |
+             1 +  ooo
+               |       o
+     weight    |        o
+             0 +         ooo0
+               +----+----+-----
+                   .5   .8
+                 anomalyscore
+    ```
+    """
+
+    # The fitting parabola a * score ** 2 + b * score + c has vertex in (0.5, 1)
+    # and passes through (maxscore, 0). The coefficients (calculated manually) are:
+    _B = 1. / (Score2Weight.maxscore ** 2 - Score2Weight.maxscore + 0.25)
+    _A = -_B
+    _C = 1. - _B / 4.0
+
+    @classmethod
+    def _to_weights(cls, scores):
+        # weights = (a * scores + b) * scores + c (Horner form), in-place:
+        weights = scores * cls._A
+        weights += cls._B
+        weights *= scores
+        weights += cls._C
+        weights[scores <= 0.5] = 1.
+        return weights
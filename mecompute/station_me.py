@@ -7,11 +7,13 @@ See `main` below for details
 
 # from collections import OrderedDict
 # from datetime import datetime, timedelta  # always useful
-# from math import factorial  # for savitzky_golay function
+from bisect import bisect_right
+
 # import numpy for efficient computation:
 import numpy as np
 # import pandas as pd
 from scipy.interpolate import CubicSpline
+from scipy.signal import detrend
 from scipy.constants import pi
 # from scipy import stats
 # import obspy.signal
@@ -20,11 +22,10 @@ from obspy import UTCDateTime  # , read, Trace, Stream,
 # from obspy.taup import TauPyModel
 # from obspy.signal.konnoohmachismoothing import konno_ohmachi_smoothing
 
-# straem2segment functions for processing obspy Traces. This is just a list of possible
-# functions to show how to import them:
+# straem2segment functions for processing obspy Traces (see the module
+# `stream2segment.process.funclib.traces` for a list of all available functions):
 from stream2segment.process import SkipSegment
-from stream2segment.process.funclib.traces import bandpass, cumsumsq,\
-    fft, ampspec, powspec, timeof, sn_split
+from stream2segment.process.funclib.traces import bandpass, ampspec, powspec, sn_split
 # stream2segment function for processing numpy arrays:
 from stream2segment.process.funclib.ndarrays import triangsmooth, snr
 
@@ -34,6 +35,31 @@ except ImportError:
     trace_score = lambda *a, **w: np.nan
 
 
+# distance corrections cache (duration -> (freq_dist_table, corrections)), where
+# corrections is the tuple returned by `get_distance_correction` from the given table:
+_DISTANCE_CORRECTIONS = {}
+# number of spectrum bins beyond the max interpolation frequency used to fit the
+# cubic spline. The influence of a far bin on the spline decays as ~0.27 ** distance
+# (in bins), so beyond ~30 bins the spline values are the same as those of the spline
+# fitted on the whole spectrum (up to machine precision), at a fraction of the cost:
+_SPLINE_MARGIN = 32
+
+
+def _v_cost(v_dens, v_pwave, v_swave):
+    v_cost_p = (1. /(15. * pi * v_dens * (v_pwave ** 5)))
+    v_cost_s = (1. /(10. * pi * v_dens * (v_swave ** 5)))
+    return v_cost_p + v_cost_s
+
+
+# energy velocity constants for event depths < 10 km, < 18 km, and >= 18 km:
+_V_COSTS_DEPTH_BOUNDS_KM = (10, 18)
+_V_COSTS = (
+    _v_cost(v_dens=2800, v_pwave=6500, v_swave=3850),
+    _v_cost(v_dens=2920, v_pwave=6800, v_swave=3900),
+    _v_cost(v_dens=3641, v_pwave=8035.5, v_swave=4483.9)
+)
+
+
 def compute_station_me(segment, config):
     """Main processing function, called iteratively for any segment selected from `imap`
     or `process` functions of stream2segment, and computing the station energy magnitude
@@ -119,12 +145,40 @@ def compute_station_me(segment, config):
     # If you want to preserve the original stream, store trace.copy()
     # or use segment.stream(True). Note that bandpass function assures the trace is one
     # (no gaps/overlaps)
+
+    # the signal window duration (depending on the event magnitude), computed once:
+    duration = get_segment_window_duration(segment, config)
     try:
+        # compute the saturation now, before the raw trace is modified in-place:
+        amp_ratio = amplitude_ratio(segment.stream()[0])
+        # skip segments early, i.e. before the costly response removal, if set:
+        if amp_ratio >= config['amp_ratio_threshold'] and \
+                config.get('skip_saturated', False):
+            raise SkipSegment('Saturated signal')
+        pre_snr_threshold = config.get('pre_snr_threshold', None)
+        if pre_snr_threshold is not None:
+            try:
+                raw_snr_ = raw_snr(segment, config, duration)
+            except Exception as exc:  # noqa
+                raise SkipSegment('%s in raw_snr' % str(exc.__class__))
+            if raw_snr_ < pre_snr_threshold:
+                raise SkipSegment('Low SNR (raw signal)')
         trace = bandpass_remresp(segment, config)
+    except SkipSegment:
+        raise
     except Exception as exc:  # noqa
         raise SkipSegment('%s in bandpass_remresp' % str(exc.__class__))
 
-    spectra = signal_noise_spectra(segment, config)
+    ##############
+    # SATURATION #
+    ##############
+
+    # flag saturated signals (according to the threshold set in the config file):
+    flag_ratio = 1
+    if amp_ratio >= config['amp_ratio_threshold']:
+        flag_ratio = 0
+
+    spectra = signal_noise_spectra(segment, config, trace, duration)
     normal_f0, normal_df, normal_spe = spectra['Signal']
     noise_f0, noise_df, noise_spe = spectra['Noise']
 
@@ -146,81 +200,51 @@ def compute_station_me(segment, config):
     # ME COMPUTATION #
     ##################
 
-    normal_spe *= trace.stats.delta
+    frequencies, trapz_weights, correction = get_distance_correction(config, duration)
 
-    duration = get_segment_window_duration(segment, config)
-
-    if duration == 60:
-        freq_min_index = 1  # 0.015625 (see frequencies in yaml)
-    else:
-        freq_min_index = 0  # 0.012402 (see frequencies in yaml)
-
-    freq_dist_table = config['freq_dist_table']
-    frequencies = freq_dist_table['frequencies'][freq_min_index:]
-    distances = freq_dist_table['distances']
+    # calculate spectra with spline interpolation on given frequencies. Fit the spline
+    # only on the bins we need, see `_SPLINE_MARGIN` for details:
+    n_bins = min(len(normal_spe),
+                 int(np.ceil((frequencies[-1] - normal_f0) / normal_df)) + 1 +
+                 _SPLINE_MARGIN)
+    normal_freqs = normal_f0 + np.arange(n_bins) * normal_df
     try:
-        distances_table = freq_dist_table[duration]
-    except KeyError:
-        raise KeyError(f'no freq dist table implemented for {duration} seconds')
-
-    # unnecessary asserts just used for testing (comment out):
-    # assert sorted(distances) == distances
-    # assert sorted(frequencies) == frequencies
-
-    # calculate spectra with spline interpolation on given frequencies:
-    normal_freqs = np.linspace(normal_f0,
-                               normal_f0 + len(normal_spe) * normal_df,
-                               num=len(normal_spe), endpoint=True)
-    try:
-        cs = CubicSpline(normal_freqs, normal_spe)
+        cs = CubicSpline(normal_freqs, normal_spe[:n_bins])
     except ValueError as verr:
         raise SkipSegment('ValueError in CubicSpline')
 
     seg_spectrum = cs(frequencies)
 
-    seg_spectrum_log10 = np.log10(seg_spectrum)
+    # negative values have no log10 (the correction is in log10 space), Me is NaN:
+    if (seg_spectrum < 0).any():
+        raise SkipSegment('Me NaN')
 
     distance_deg = segment.event_distance_deg
-    if distance_deg < distances[0] or distance_deg > distances[-1]:
+    if distance_deg < correction.x[0] or distance_deg > correction.x[-1]:
         # just for safety (see segments_selection.yaml):
         raise SkipSegment('event distance out of bounds')
 
-    distindex = np.searchsorted(distances, distance_deg)
+    # (note: at table distances, the spline returns the table values scaled by
+    # -2 ln(10), see `get_distance_correction`)
+    correction_exponent = correction(distance_deg)
 
-    if distances[distindex] == distance_deg:
-        correction_spectrum_log10 = distances_table[distindex]
-    else:
-        distances_table = np.array(distances_table).reshape(len(distances),
-                                                            len(frequencies))
-        css = [CubicSpline(distances, distances_table[:, i])
-               for i in range(len(frequencies))]
-        correction_spectrum_log10 = [css[freqindex](distance_deg)
-                                     for freqindex in range(len(frequencies))]
+    # corrected squared spectrum 10 ** (2 * (log10(seg) - corr_log10)), computed as
+    # seg ** 2 * exp(-2 * ln(10) * corr_log10) in-place (no log10, no temporary
+    # arrays):
+    corrected_spectrum = np.exp(correction_exponent, out=correction_exponent)
+    corrected_spectrum *= seg_spectrum
+    corrected_spectrum *= seg_spectrum
 
-    corrected_spectrum = seg_spectrum_log10 - correction_spectrum_log10
-
-    corrected_spectrum = np.power(10, corrected_spectrum) ** 2  # convert log10A -> A^2:
-
-    corrected_spectrum_int_vel_square = np.trapz(corrected_spectrum, frequencies)
+    # trapezoidal rule (as `np.trapz`, but with the weights computed once).
+    # Note: the signal spectrum should be multiplied by the trace delta: as the
+    # corrected spectrum is quadratic in it, multiply the integral by delta ** 2:
+    corrected_spectrum_int_vel_square = \
+        trace.stats.delta ** 2 * float(corrected_spectrum @ trapz_weights)
 
     depth_km = segment.event.depth_km
-    if depth_km < 10:
-        v_dens = 2800
-        v_pwave = 6500
-        v_swave = 3850
-    elif depth_km < 18:
-        v_dens = 2920
-        v_pwave = 6800
-        v_swave = 3900
-    else:
-        v_dens = 3641
-        v_pwave = 8035.5
-        v_swave = 4483.9
-
-    v_cost_p = (1. /(15. * pi * v_dens * (v_pwave ** 5)))
-    v_cost_s = (1. /(10. * pi * v_dens * (v_swave ** 5)))
+    v_cost = _V_COSTS[bisect_right(_V_COSTS_DEPTH_BOUNDS_KM, depth_km)]
     # below I put a factor 2 but ... we don't know yet if it is needed
-    energy = 2 * (v_cost_p + v_cost_s) * corrected_spectrum_int_vel_square
+    energy = 2 * v_cost * corrected_spectrum_int_vel_square
     me_st = (2./3.) * (np.log10(energy) - 4.4)
 
     if not np.isfinite(me_st):
@@ -228,27 +252,18 @@ def compute_station_me(segment, config):
 
     # END OF ME COMPUTATION =============================================
 
-    # Reload (raw) trace (raw) for the final computations (anomaly score and saturation):
-    trace = segment.stream(reload=True)[0]
-
     ###########################
     # AMPLITUDE ANOMALY SCORE #
     ###########################
 
-    try:
-        aascore = trace_score(trace, segment.inventory())
-    except Exception as exc:
-        aascore = np.nan
-
-    ##############
-    # SATURATION #
-    ##############
-
-    # discard saturated signals (according to the threshold set in the config file):
-    amp_ratio = np.true_divide(np.nanmax(np.abs(trace.data)), 2**23)
-    flag_ratio = 1
-    if amp_ratio >= config['amp_ratio_threshold']:
-        flag_ratio = 0
+    aascore = np.nan
+    if flag_ratio:  # saturated signals are already flagged, skip the (costly) score
+        # reload the raw trace for the anomaly score:
+        trace = segment.stream(reload=True)[0]
+        try:
+            aascore = trace_score(trace, segment.inventory())
+        except Exception as exc:
+            pass
 
     ################################
     # BUILD AND RETURN OUTPUT DICT #
@@ -317,6 +332,15 @@ def bandpass_remresp(segment, config):
     return trace
 
 
+def amplitude_ratio(trace):
+    """Return the ratio between the maximum absolute amplitude of the given trace
+    (in counts, NaNs ignored) and 2**23, i.e. the full scale of a 24-bit digitizer"""
+    data = trace.data
+    # max(abs(data)) via two reductions, without allocating abs(data). Convert to
+    # Python float first, as abs(min int) might overflow for integer arrays:
+    return max(abs(float(np.nanmax(data))), abs(float(np.nanmin(data)))) / 2**23
+
+
 def assert1trace(stream):
     """Assert the stream has only one trace, raising an Exception if it's not the case,
     as this is the pre-condition for all processing functions implemented here.
@@ -327,10 +351,15 @@ def assert1trace(stream):
         raise SkipSegment("%d traces (probably gaps/overlaps)" % len(stream))
 
 
-def signal_noise_spectra(segment, config):
+def signal_noise_spectra(segment, config, trace=None, duration=None):
     """Compute the signal and noise spectra, as dict of strings mapped to
     tuples (x0, dx, y). Does not modify the segment's stream or traces in-place
 
+    :param trace: the segment trace, if already available (e.g., returned by
+        `bandpass_remresp`). If None (the default), `segment.stream()[0]`
+    :param duration: the signal window duration, if already available. If None
+        (the default), `get_segment_window_duration(segment, config)`
+
     :return: a dict with two keys, 'Signal' and 'Noise', mapped respectively to
         the tuples (f0, df, frequencies)
 
@@ -340,19 +369,16 @@ def signal_noise_spectra(segment, config):
     # (this function assumes stream has only one trace)
     atime_shift = config['sn_windows']['arrival_time_shift']
     arrival_time = UTCDateTime(segment.arrival_time) + atime_shift
-    duration = get_segment_window_duration(segment, config)
-    signal_trace, noise_trace = sn_split(segment.stream()[0], arrival_time, duration)
+    if duration is None:
+        duration = get_segment_window_duration(segment, config)
+    if trace is None:
+        trace = segment.stream()[0]
+    signal_trace, noise_trace = sn_split(trace, arrival_time, duration)
 
     signal_trace.taper(0.05, type='cosine')
-    dura_sec = signal_trace.stats.delta * (8192-1)
-    signal_trace.trim(starttime=signal_trace.stats.starttime,
-                      endtime=signal_trace.stats.endtime+dura_sec, pad=True,
-                      fill_value=0)
-    dura_sec = noise_trace.stats.delta * (8192-1)
+    _zero_pad(signal_trace, 8192-1)
     noise_trace.taper(0.05, type='cosine')
-    noise_trace.trim(starttime=noise_trace.stats.starttime,
-                     endtime=noise_trace.stats.endtime+dura_sec, pad=True,
-                     fill_value=0)
+    _zero_pad(noise_trace, 8192-1)
 
     x0_sig, df_sig, sig = _spectrum(signal_trace, config)
     x0_noi, df_noi, noi = _spectrum(noise_trace, config)
@@ -360,6 +386,35 @@ def signal_noise_spectra(segment, config):
     return {'Signal': (x0_sig, df_sig, sig), 'Noise': (x0_noi, df_noi, noi)}
 
 
+def _zero_pad(trace, npts):
+    """Append `npts` zeros to the trace data, in a single allocation (same result
+    as `trace.trim(endtime=trace.stats.endtime + npts * trace.stats.delta, pad=True,
+    fill_value=0)`). Modifies the trace in-place (ObsPy updates `trace.stats.npts`)
+    """
+    data = trace.data
+    padded = np.zeros(len(data) + npts, dtype=data.dtype)
+    padded[:len(data)] = data
+    trace.data = padded
+
+
+def raw_snr(segment, config, duration=None):
+    """Return a coarse signal-to-noise ratio of the raw (unfiltered) segment trace,
+    computed in the time domain as the ratio between the signal and noise window
+    variances (i.e., a power ratio) after removing the linear trend from each
+    window. Used to skip noisy segments before the (costly) filtering, response
+    removal and spectra computation. Note that the ratio is broadband (long-period
+    noise such as microseisms is not filtered out), so it is only an approximation
+    of the SNR computed on the spectra.
+    `duration` is the signal window duration, as in `signal_noise_spectra`
+    """
+    atime_shift = config['sn_windows']['arrival_time_shift']
+    arrival_time = UTCDateTime(segment.arrival_time) + atime_shift
+    if duration is None:
+        duration = get_segment_window_duration(segment, config)
+    signal_trace, noise_trace = sn_split(segment.stream()[0], arrival_time, duration)
+    return np.var(detrend(signal_trace.data)) / np.var(detrend(noise_trace.data))
+
+
 def get_segment_window_duration(segment, config):
     magnitude = segment.event.magnitude
     magrange2duration = config['magrange2duration']
@@ -369,6 +424,61 @@ def get_segment_window_duration(segment, config):
     return 90
 
 
+def get_distance_correction(config, duration):
+    """Return the tuple `(frequencies, trapz_weights, correction)` for the given
+    segment window duration, built from `config['freq_dist_table']`: `frequencies` is
+    a numpy array, `trapz_weights` the trapezoidal rule weights over `frequencies`
+    (so that `y @ trapz_weights` equals `np.trapz(y, frequencies)`) and `correction`
+    is the CubicSpline of the table of the given duration over the table distances
+    (`correction.x`). The table holds log10 correction spectra, and the spline is
+    built on the table values multiplied by -2 ln(10), so that
+    `np.exp(correction(distance))` returns the factor `10 ** (-2 * corr_log10)`
+    that corrects a squared spectrum at the given distance (one value per
+    frequency).
+
+    As the returned objects depend only on the duration and
+    `config['freq_dist_table']`, they are computed once and cached (see
+    `_DISTANCE_CORRECTIONS`)
+    """
+    freq_dist_table = config['freq_dist_table']
+    cached_table, corrections = _DISTANCE_CORRECTIONS.get(duration, (None, None))
+    if cached_table == freq_dist_table:
+        return corrections
+
+    if duration == 60:
+        freq_min_index = 1  # 0.015625 (see frequencies in yaml)
+    else:
+        freq_min_index = 0  # 0.012402 (see frequencies in yaml)
+
+    frequencies = np.asarray(freq_dist_table['frequencies'][freq_min_index:],
+                             dtype=float)
+    # check once here, per run, that frequencies are sorted (the same check for the
+    # distances is performed by `CubicSpline` below):
+    if (np.diff(frequencies) <= 0).any():
+        raise ValueError('freq_dist_table frequencies must be sorted ascending')
+    distances = np.asarray(freq_dist_table['distances'], dtype=float)
+    try:
+        distances_table = freq_dist_table[duration]
+    except KeyError:
+        raise KeyError(f'no freq dist table implemented for {duration} seconds')
+    # table columns are all `freq_dist_table['frequencies']`, take only those we need:
+    distances_table = np.asarray(distances_table, dtype=float)[:, freq_min_index:]
+    # 10 ** (-2 * table) = exp(-2 * ln(10) * table): scale the table once here:
+    distances_table *= -2 * np.log(10)
+    # interpolate all frequencies (table columns) at once:
+    correction = CubicSpline(distances, distances_table, axis=0)
+
+    freq_steps = np.diff(frequencies)
+    trapz_weights = np.zeros(len(frequencies))
+    trapz_weights[:-1] += freq_steps
+    trapz_weights[1:] += freq_steps
+    trapz_weights *= 0.5
+
+    corrections = frequencies, trapz_weights, correction
+    _DISTANCE_CORRECTIONS[duration] = freq_dist_table, corrections
+    return corrections
+
+
 def _spectrum(trace, config, starttime=None, endtime=None):
     """Calculate the spectrum of a trace. Returns the tuple (0, df, values),
     where values depends on the config dict parameters.
@@ -1,15 +1,19 @@
 import os
+from copy import deepcopy
 from datetime import datetime, timedelta
 
+from functools import lru_cache
 from os.path import dirname, join, abspath, isfile
 
+import numpy as np
 import pandas as pd
 import pytest
 from click.testing import CliRunner
 
-from mecompute.cli import cli
-from mecompute.event_me import ParabolicScore2Weight, LinearScore2Weight
-from unittest.mock import patch
+from mecompute.cli import cli, write_quakemls
+from mecompute.event_me import ParabolicScore2Weight, LinearScore2Weight, \
+    events_me_stats, avg_std_count_within_percentiles
+from unittest.mock import patch, MagicMock
 
 TEST_DATA_DIR = abspath(join(dirname(__file__), 'data'))
 TEST_DOWNLOAD_CONFIG_PATH = join(TEST_DATA_DIR, 'download.yaml')
@@ -97,3 +101,251 @@ def test_weighter():
     for cls in (LinearScore2Weight, ParabolicScore2Weight):
         values = cls.convert(scores)
         assert (np.diff(values) <= 0).all()
+
+
+def test_events_me_stats():
+    """Tests that the vectorized events Me statistics are the same as those
+    computed event-wise
+    """
+    import numpy as np
+    rng = np.random.default_rng(0)
+    # 30 events, one with 2 Me (no value within percentiles), one with no finite Me:
+    ev_ids = np.concatenate([np.repeat(np.arange(30), rng.integers(3, 20, 30)),
+                             [30, 30, 31]])
+    me = rng.normal(5, 0.5, len(ev_ids))
+    me[rng.random(len(me)) < 0.1] = np.nan
+    me[-3:] = [5.1, 5.3, np.nan]
+    dfr = pd.DataFrame({
+        'event_db_id': ev_ids,
+        'network': 'N',
+        'station': rng.integers(0, 5, len(ev_ids)).astype(str),
+        'station_energy_magnitude': me
+    })
+    stats = events_me_stats(dfr)
+    assert stats.index.tolist() == list(range(32))
+    for ev_id, evt_df in dfr.groupby('event_db_id'):
+        values = evt_df['station_energy_magnitude'].values
+        row = stats.loc[ev_id]
+        assert row['waveforms'] == np.isfinite(values).sum()
+        assert row['stations'] == evt_df['station'].nunique()
+        if ev_id == 31:
+            assert row['waveforms'] == 0
+            continue
+        me_, me_std, count = avg_std_count_within_percentiles(values)
+        assert row['Me_waveforms_used'] == count
+        if ev_id == 30:
+            assert count == 0 and np.isnan(row['Me'])
+        else:
+            assert np.isclose(row['Me'], me_) and np.isclose(row['Me_stddev'], me_std)
+
+
+@patch('mecompute.cli.logger')
+@patch('mecompute.cli._write_quekeml')
+@patch('mecompute.cli.urlopen')
+def test_write_quakemls(mock_urlopen, mock_write_quekeml, mock_logger):
+    """Tests that QuakeMLs are downloaded concurrently but written serially in the
+    events order, and that invalid events are skipped without downloading them
+    """
+    from urllib.error import URLError
+
+    def urlopen(url):
+        if url == 'bad_url':
+            raise URLError('download error')
+        response = MagicMock()
+        response.__enter__.return_value.read.return_value = url.encode('utf8')
+        return response
+
+    mock_urlopen.side_effect = urlopen
+    events = {
+        i: {'id': str(i), 'url': url, 'Me': me, 'Me_stddev': 0.1,
+            'Me_waveforms_used': 3}
+        for i, (url, me) in enumerate([('url1', 5.), ('bad_url', 5.),
+                                       ('url3', float('nan')), ('url4', 6.)])
+    }
+    write_quakemls(events, TEST_TMP_ROOT_DIR)
+    # url3 has NaN Me, so it is not downloaded:
+    assert sorted(_[0][0] for _ in mock_urlopen.call_args_list) == \
+           ['bad_url', 'url1', 'url4']
+    # only the successfully downloaded QuakeMLs are written, in order:
+    written = [(c[0][0], c[0][1].read()) for c in mock_write_quekeml.call_args_list]
+    assert written == [(join(TEST_TMP_ROOT_DIR, '0.xml'), b'url1'),
+                       (join(TEST_TMP_ROOT_DIR, '3.xml'), b'url4')]
+    # the events not written are logged:
+    assert len(mock_logger.warning.call_args_list) == 2
+
+
+@lru_cache()
+def _load_station_me_config():
+    import yaml
+    from mecompute.cli import STATION_ME_CONFIG_PATH
+    with open(STATION_ME_CONFIG_PATH) as _:
+        return yaml.safe_load(_)
+
+
+def _station_me_config():
+    """Return a copy of the default station_me config (the YAML is parsed once)"""
+    return deepcopy(_load_station_me_config())
+
+
+# signal spectrum (f0, df, values) of the segments processed in `_compute_station_me`:
+_SIGNAL_SPECTRUM = (0., 0.01, 1. / (1. + np.arange(4097) * 0.01))
+
+
+def _compute_station_me(mocks, amp_ratio, raw_snr=10., distance_deg=50.,
+                        **config_updates):
+    """Run `compute_station_me` on a mock segment with mocked waveform processing
+    and a synthetic signal spectrum (`_SIGNAL_SPECTRUM`), and return the result.
+    `mocks` is a dict that will be populated with the patched functions (by name).
+    `raw_snr` is the value returned by the patched `raw_snr`, or the exception raised
+    """
+    from mecompute.station_me import compute_station_me
+
+    config = _station_me_config()
+    config.update(config_updates)
+    segment = MagicMock()
+    segment.event.magnitude = 5.
+    segment.event.depth_km = 10.
+    segment.event_distance_deg = distance_deg
+    trace = MagicMock()
+    trace.stats.delta = 0.01
+    trace.stats.sampling_rate = 100.
+    spectra = {'Signal': _SIGNAL_SPECTRUM,
+               'Noise': (0., 0.01, np.full(len(_SIGNAL_SPECTRUM[2]), 1e-3))}
+    names = ['amplitude_ratio', 'bandpass_remresp', 'signal_noise_spectra', 'snr',
+             'raw_snr']
+    patchers = {n: patch('mecompute.station_me.' + n) for n in names}
+    mocks.update({n: p.start() for n, p in patchers.items()})
+    try:
+        mocks['amplitude_ratio'].return_value = amp_ratio
+        mocks['bandpass_remresp'].return_value = trace
+        mocks['signal_noise_spectra'].return_value = spectra
+        mocks['snr'].return_value = 10.
+        if isinstance(raw_snr, Exception):
+            mocks['raw_snr'].side_effect = raw_snr
+        else:
+            mocks['raw_snr'].return_value = raw_snr
+        return compute_station_me(segment, config)
+    finally:
+        for p in patchers.values():
+            p.stop()
+
+
+def test_skip_saturated():
+    """Tests that saturated segments are skipped before any processing if
+    `skip_saturated` is true, and flagged otherwise
+    """
+    from stream2segment.process import SkipSegment
+
+    mocks = {}
+    with pytest.raises(SkipSegment) as exc:
+        _compute_station_me(mocks, 0.9, skip_saturated=True)
+    assert 'Saturated signal' in str(exc.value)
+    assert not mocks['bandpass_remresp'].called
+
+    for skip_saturated in [True, False]:
+        # non-saturated segment, always processed:
+        result = _compute_station_me(mocks, 0.1, skip_saturated=skip_saturated)
+        assert result['signal_is_saturated'] == 1
+        assert np.isfinite(result['station_energy_magnitude'])
+
+    # saturated segment, processed and flagged:
+    result = _compute_station_me(mocks, 0.9, skip_saturated=False)
+    assert mocks['bandpass_remresp'].called
+    assert result['signal_is_saturated'] == 0
+    assert np.isfinite(result['station_energy_magnitude'])
+    assert np.isnan(result['signal_amplitude_anomaly_score'])
+
+
+def test_pre_snr_threshold():
+    """Tests that segments with a low raw SNR are skipped before any processing
+    only if `pre_snr_threshold` is set
+    """
+    from stream2segment.process import SkipSegment
+
+    mocks = {}
+    # no threshold (default), raw SNR not computed:
+    result = _compute_station_me(mocks, 0.1, raw_snr=0.1)
+    assert not mocks['raw_snr'].called
+    assert np.isfinite(result['station_energy_magnitude'])
+    result = _compute_station_me(mocks, 0.1, raw_snr=0.1, pre_snr_threshold=None)
+    assert not mocks['raw_snr'].called
+    assert np.isfinite(result['station_energy_magnitude'])
+
+    # threshold set, raw SNR high enough:
+    result = _compute_station_me(mocks, 0.1, raw_snr=3., pre_snr_threshold=2)
+    assert mocks['raw_snr'].called
+    assert np.isfinite(result['station_energy_magnitude'])
+
+    # threshold set, raw SNR too low:
+    with pytest.raises(SkipSegment) as exc:
+        _compute_station_me(mocks, 0.1, raw_snr=1., pre_snr_threshold=2)
+    assert 'Low SNR (raw signal)' in str(exc.value)
+    assert not mocks['bandpass_remresp'].called
+
+    # raw SNR errors are reported as such:
+    with pytest.raises(SkipSegment) as exc:
+        _compute_station_me(mocks, 0.1, raw_snr=ValueError(), pre_snr_threshold=2)
+    assert 'ValueError' in str(exc.value) and 'in raw_snr' in str(exc.value)
+    assert not mocks['bandpass_remresp'].called
+
+
+@patch('mecompute.station_me.UTCDateTime')
+@patch('mecompute.station_me.sn_split')
+def test_raw_snr(mock_sn_split, mock_utcdatetime):
+    """Tests that the raw SNR is not affected by offsets and linear trends"""
+    from mecompute.station_me import raw_snr
+
+    rng = np.random.default_rng(0)
+    times = np.arange(9000) * 0.01
+    noise = rng.normal(size=len(times))
+    signal = 3 * np.sin(2 * np.pi * times)
+    noise_trace, signal_trace = MagicMock(), MagicMock()
+    mock_sn_split.return_value = signal_trace, noise_trace
+    config = {'sn_windows': {'arrival_time_shift': 0}}
+
+    noise_trace.data, signal_trace.data = noise, signal + noise
+    expected = raw_snr(MagicMock(), config, 90)
+    assert expected > 1
+    # add offset and drift:
+    noise_trace.data = 1000 + 50 * times + noise
+    signal_trace.data = 1000 + 50 * (times[-1] + times) + signal + noise
+    assert np.isclose(raw_snr(MagicMock(), config, 90), expected)
+
+
+@pytest.mark.parametrize('duration', [60, 90, 120, 180])
+def test_corrected_spectrum_integral(duration):
+    """Tests that the corrected spectrum integral computed in `compute_station_me`
+    equals the one computed with the original implementation, i.e. log10 of the
+    spline interpolated spectrum minus the log10 correction, interpolated on each
+    table frequency, and `np.trapz`. Tests also the resulting Me
+    """
+    from scipy.interpolate import CubicSpline
+
+    table = _station_me_config()['freq_dist_table']
+    frequencies = table['frequencies'][1 if duration == 60 else 0:]
+    distances = table['distances']
+    # table columns are all table frequencies (see `get_distance_correction`):
+    corrections = np.asarray(table[duration])[:, -len(frequencies):]
+    delta = 0.01  # see `_compute_station_me`
+    f0, df, spectrum = _SIGNAL_SPECTRUM
+    freqs = f0 + np.arange(len(spectrum)) * df
+    seg_spectrum_log10 = np.log10(CubicSpline(freqs, spectrum * delta)(frequencies))
+    trapz = getattr(np, 'trapezoid', None) or np.trapz
+    # velocities and density for the depth of the segments (10 km), as Me constant:
+    v_dens, v_pwave, v_swave = 2920, 6800, 3900
+    v_cost = 1. / (15. * np.pi * v_dens * (v_pwave ** 5)) + \
+        1. / (10. * np.pi * v_dens * (v_swave ** 5))
+
+    for distance_deg in [distances[0], distances[3], 51.3, distances[-1]]:
+        correction_log10 = [CubicSpline(distances, corrections[:, j])(distance_deg)
+                            for j in range(len(frequencies))]
+        expected = trapz(10 ** (2 * (seg_spectrum_log10 - correction_log10)),
+                         frequencies)
+        result = _compute_station_me({}, 0.1, distance_deg=distance_deg,
+                                     magrange2duration=[[0, 10, duration]])
+        assert np.isclose(
+            result['signal_corrected_spectrum_velocity_squared_integral'],
+            expected, rtol=1e-10, atol=0)
+        me_st = (2. / 3.) * (np.log10(2 * v_cost * expected) - 4.4)
+        assert np.isclose(result['station_energy_magnitude'], me_st, rtol=1e-10,
+                          atol=0)